@@ -2,15 +2,21 @@ from __future__ import annotations
 
 import os
 from dataclasses import dataclass
+from functools import lru_cache
 
 
-@dataclass
+@dataclass(frozen=True)
 class Settings:
     environment: str = os.getenv("ENVIRONMENT", "production")  # production/dev
+    database_url: str = os.getenv("DATABASE_URL", "")
     frontend_url: str = os.getenv("FRONTEND_URL", "https://pgrsportsanalytics.com")
     backend_base_url: str = os.getenv("BACKEND_BASE_URL", "https://pgr-backend-production.up.railway.app")
     frontend_success_url: str = os.getenv("FRONTEND_SUCCESS_URL", "https://pgrsportsanalytics.com/premium/access/")
 
+    # Server (python -m app.main / uvicorn)
+    port: int = int(os.getenv("PORT", "5000"))
+    web_concurrency: int = int(os.getenv("WEB_CONCURRENCY", "1"))  # uvicorn worker processes
+
     # Discord OAuth
     discord_client_id: str | None = os.getenv("DISCORD_CLIENT_ID")
     discord_client_secret: str | None = os.getenv("DISCORD_CLIENT_SECRET")
@@ -26,9 +32,18 @@ class Settings:
     stripe_webhook_secret: str | None = os.getenv("STRIPE_WEBHOOK_SECRET")
     stripe_price_id: str | None = os.getenv("STRIPE_PRICE_ID")  # price_xxx
 
+    # Database pool (per worker process)
+    db_pool_size: int = int(os.getenv("DB_POOL_SIZE", "20"))
+    db_max_overflow: int = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+    db_pool_timeout: int = int(os.getenv("DB_POOL_TIMEOUT", "10"))
+    db_webhook_pool_size: int = int(os.getenv("DB_WEBHOOK_POOL_SIZE", "5"))  # separate pool for Stripe webhook writes
+    db_webhook_max_overflow: int = int(os.getenv("DB_WEBHOOK_MAX_OVERFLOW", "10"))
+    db_pgbouncer: bool = os.getenv("DB_PGBOUNCER", "false").lower() == "true"  # DATABASE_URL points at PgBouncer (transaction mode)
+
     # Cookie behavior
     cookie_secure: bool = os.getenv("COOKIE_SECURE", "true").lower() == "true"
 
 
+@lru_cache(maxsize=1)
 def get_settings() -> Settings:
     return Settings()
@@ -1,14 +1,23 @@
 from __future__ import annotations
 
-import os
+import logging
+import uuid
+from functools import cache
+from sqlalchemy import inspect
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
 
-DATABASE_URL = os.getenv("DATABASE_URL", "")
+from app.config import get_settings
 
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+@cache
 def convert_database_url(url: str) -> str:
     parsed = urlparse(url)
+    if parsed.scheme == "postgresql+asyncpg":
+        return url
     new_scheme = "postgresql+asyncpg"
     query_params = parse_qs(parsed.query)
     query_params.pop('sslmode', None)
@@ -16,15 +25,34 @@ def convert_database_url(url: str) -> str:
     new_parsed = parsed._replace(scheme=new_scheme, query=new_query)
     return urlunparse(new_parsed)
 
-database_url = convert_database_url(DATABASE_URL)
+database_url = convert_database_url(settings.database_url)
 
-engine = create_async_engine(
-    database_url,
-    echo=False,
-    pool_pre_ping=True,
-    pool_recycle=300,
-    connect_args={"ssl": True} if "neon" in DATABASE_URL else {},
-)
+_SSL_CONNECT_ARGS = {"ssl": True} if "neon.tech" in (urlparse(settings.database_url).hostname or "") else {}
+
+connect_args: dict = dict(_SSL_CONNECT_ARGS)
+if settings.db_pgbouncer:
+    # PgBouncer in transaction mode hands each transaction a different backend,
+    # so asyncpg must not rely on named server-side prepared statements.
+    connect_args.update(
+        statement_cache_size=0,
+        prepared_statement_cache_size=0,
+        prepared_statement_name_func=lambda: f"__asyncpg_{uuid.uuid4()}__",
+    )
+
+def _make_engine(pool_size: int, max_overflow: int):
+    return create_async_engine(
+        database_url,
+        echo=False,
+        query_cache_size=1200,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_pre_ping=True,
+        pool_recycle=300,
+        connect_args=connect_args,
+    )
+
+engine = _make_engine(settings.db_pool_size, settings.db_max_overflow)
 
 async_session_maker = async_sessionmaker(
     engine,
@@ -32,6 +60,16 @@ async_session_maker = async_sessionmaker(
     expire_on_commit=False,
 )
 
+# Stripe webhooks get their own small pool so a redelivery burst cannot
+# starve user-facing requests of connections.
+webhook_engine = _make_engine(settings.db_webhook_pool_size, settings.db_webhook_max_overflow)
+
+webhook_session_maker = async_sessionmaker(
+    webhook_engine,
+    class_=AsyncSession,
+    expire_on_commit=False,
+)
+
 class Base(DeclarativeBase):
     pass
 
@@ -42,7 +80,32 @@ async def get_db():
         finally:
             await session.close()
 
+async def get_webhook_db():
+    async with webhook_session_maker() as session:
+        try:
+            yield session
+        finally:
+            await session.close()
+
+def _missing_schema(conn) -> list[str]:
+    # create_all skips tables that already exist, so columns and indexes
+    # added to a model later reach older databases through migrations/.
+    inspector = inspect(conn)
+    missing: list[str] = []
+    for table in Base.metadata.sorted_tables:
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        missing += [f"{table.name}.{column.name}" for column in table.columns if column.name not in columns]
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        missing += [index.name for index in table.indexes if index.name not in indexes]
+    return missing
+
 async def init_db():
     import app.models  # noqa: F401
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        missing = await conn.run_sync(_missing_schema)
+    if missing:
+        # Discord login upserts ON CONFLICT (lower(email)) and fails outright
+        # without ix_users_email_lower; Stripe events cannot be marked applied
+        # without stripe_events.processed_at.
+        logger.error("Database is missing %s; apply migrations/ as described in replit.md", ", ".join(missing))
@@ -1,24 +1,86 @@
+import asyncio
+import logging
+import logging.handlers
+import queue
 from contextlib import asynccontextmanager
 
+import stripe
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from app.database import get_db
 from app.config import get_settings
 from app.database import init_db
 from app.routers import health_router, discord_router, stripe_router
+from app.services.discord import drain_role_changes, role_worker
+from app.services.http import create_http_client
+from app.services.stripe_events import drain_events, event_worker, log_unfinished_events, recover_events
 
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# Seconds each in-memory queue gets to finish on shutdown.
+SHUTDOWN_DRAIN_TIMEOUT = 20
+
+# App log records are handed to a queue; a listener thread does the actual
+# stream writes so logging from handlers never blocks the event loop.
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(
+    _log_queue,
+    logging.StreamHandler(),
+    respect_handler_level=True,
+)
+
+_log_handler = logging.handlers.QueueHandler(_log_queue)
+
+def _configure_logging() -> None:
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    # The lifespan can run more than once per process (e.g. one TestClient
+    # per test); a second handler would write every record twice.
+    if _log_handler not in root.handlers:
+        root.addHandler(_log_handler)
+    # httpx logs every request at INFO; the Discord worker would flood the log.
+    logging.getLogger("httpx").setLevel(logging.WARNING)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await init_db()
-    yield
+    _configure_logging()
+    _log_listener.start()
+    try:
+        await init_db()
+        if settings.stripe_secret_key:
+            stripe.api_key = settings.stripe_secret_key
+        app.state.http = create_http_client()
+        role_task = asyncio.create_task(role_worker(app.state.http))
+        event_task = asyncio.create_task(event_worker())
+        recovery_task = asyncio.create_task(recover_events())
+        try:
+            yield
+        finally:
+            recovery_task.cancel()
+            # Acked Stripe events and queued role changes only live in memory.
+            # Events go first since applying them queues more role changes.
+            for drain, name in ((drain_events, "Stripe events"), (drain_role_changes, "Discord role changes")):
+                try:
+                    await asyncio.wait_for(drain(), SHUTDOWN_DRAIN_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logger.error("Shutdown left unfinished %s after %ss", name, SHUTDOWN_DRAIN_TIMEOUT)
+            event_task.cancel()
+            role_task.cancel()
+            await asyncio.gather(event_task, role_task, recovery_task, return_exceptions=True)
+            log_unfinished_events()
+            await app.state.http.aclose()
+    finally:
+        # Also covers a failed startup, e.g. init_db unable to connect.
+        _log_listener.stop()
 
 app = FastAPI(
     title="PGR Backend",
     version="1.0.0",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 # Viktigt: allow_credentials=True för cookies (discord_id cookie)
@@ -26,11 +88,22 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=[settings.frontend_url],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
+    max_age=86400,  # let browsers cache the preflight for a day
 )
 
 app.include_router(health_router)
 app.include_router(discord_router)
 app.include_router(stripe_router)
 
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=settings.port,
+        workers=settings.web_concurrency,
+    )
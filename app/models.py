@@ -4,7 +4,8 @@ from sqlalchemy import Enum as SAEnum
 import uuid
 from datetime import datetime, timezone
 
-from sqlalchemy import String, DateTime
+from sqlalchemy import String, DateTime, Index, Text, func, text
+from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import Mapped, mapped_column
 
 from app.database import Base
@@ -19,14 +20,43 @@ class AccessLevel(str, Enum):
     
 class User(Base):
     __tablename__ = "users"
-
-    id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    __table_args__ = (
+        # Webhooks look users up by discord_user_id; most rows never link Discord.
+        # Named apart from the full index the column used to declare, so older
+        # databases can build it alongside and drop that one (migrations/).
+        Index("ix_users_discord_user_id_partial", "discord_user_id", postgresql_where=text("discord_user_id IS NOT NULL")),
+    )
+
+    # default covers tables created before the server default existed, which
+    # create_all never alters; new tables get gen_random_uuid() as well.
+    id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True),
+        primary_key=True,
+        default=uuid.uuid4,
+        server_default=text("gen_random_uuid()"),
+    )
     email: Mapped[str] = mapped_column(String(255), unique=True, index=True, nullable=False)
 
-    discord_user_id: Mapped[str | None] = mapped_column(String(64), index=True, nullable=True)
+    discord_user_id: Mapped[str | None] = mapped_column(String(64), nullable=True)
 
     access_level: Mapped[AccessLevel] = mapped_column(SAEnum(AccessLevel, name="accesslevel"), default=AccessLevel.free, nullable=False)  # free/premium
     stripe_customer_id: Mapped[str | None] = mapped_column(String(128), nullable=True)
 
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=utcnow, nullable=False)
     updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=utcnow, onupdate=utcnow, nullable=False)
+
+
+# Case-insensitive identity for users; the Discord upsert conflicts on it so
+# legacy mixed-case rows still match a lower-cased login email.
+Index("ix_users_email_lower", func.lower(User.email), unique=True)
+
+
+class StripeEvent(Base):
+    __tablename__ = "stripe_events"
+
+    # Stripe event id; the primary key is what makes webhook claims idempotent.
+    id: Mapped[str] = mapped_column(Text, primary_key=True)
+    received_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=text("now()"), nullable=False)
+    # Set once the event is applied. Claims left without it after a crash are
+    # fetched from Stripe again and replayed.
+    processed_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
@@ -1,18 +1,25 @@
 from __future__ import annotations
 
+import hashlib
+import hmac
 import os
 import secrets
+import time
 import urllib.parse
+from functools import lru_cache
 import httpx
+import orjson
 
 from fastapi import APIRouter, Request, Depends, HTTPException
 from fastapi.responses import RedirectResponse
-from sqlalchemy import select
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.config import get_settings
 from app.database import get_db
-from app.models import User
+from app.models import AccessLevel, User
+from app.services.http import get_http
 
 router = APIRouter(prefix="/discord", tags=["discord"])
 
@@ -20,20 +27,45 @@ DISCORD_AUTH_URL = "https://discord.com/api/oauth2/authorize"
 DISCORD_TOKEN_URL = "https://discord.com/api/oauth2/token"
 DISCORD_ME_URL = "https://discord.com/api/users/@me"
 
+STATE_MAX_AGE = 10 * 60
 
-def _build_authorize_url(client_id: str, redirect_uri: str, state: str) -> str:
+
+@lru_cache(maxsize=4)
+def _authorize_url_prefix(client_id: str, redirect_uri: str) -> str:
+    # Everything but the state is fixed for the life of the process.
     params = {
         "client_id": client_id,
         "redirect_uri": redirect_uri,
         "response_type": "code",
         "scope": "identify email",
-        "state": state,
         "prompt": "consent",
     }
-    return DISCORD_AUTH_URL + "?" + urllib.parse.urlencode(params)
+    return DISCORD_AUTH_URL + "?" + urllib.parse.urlencode(params) + "&state="
+
+
+def _build_authorize_url(client_id: str, redirect_uri: str, state: str) -> str:
+    return _authorize_url_prefix(client_id, redirect_uri) + urllib.parse.quote(state, safe="")
+
+
+def _state_signature(secret: str, payload: str) -> str:
+    return hmac.new(secret.encode(), payload.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def _sign_state(secret: str) -> str:
+    # state = "<nonce>.<issued_at>.<hmac>" so it can be verified without server-side storage
+    payload = f"{secrets.token_urlsafe(24)}.{int(time.time())}"
+    return f"{payload}.{_state_signature(secret, payload)}"
+
+
+def _verify_state(secret: str, state: str) -> bool:
+    payload, _, sig = state.rpartition(".")
+    if not payload or not hmac.compare_digest(sig.encode(), _state_signature(secret, payload).encode()):
+        return False
+    issued_at = payload.rpartition(".")[2]
+    return issued_at.isdigit() and time.time() - int(issued_at) <= STATE_MAX_AGE
 
 
-async def _exchange_code_for_token(code: str, client_id: str, client_secret: str, redirect_uri: str) -> str:
+async def _exchange_code_for_token(client: httpx.AsyncClient, code: str, client_id: str, client_secret: str, redirect_uri: str) -> str:
     data = {
         "client_id": client_id,
         "client_secret": client_secret,
@@ -42,20 +74,18 @@ async def _exchange_code_for_token(code: str, client_id: str, client_secret: str
         "redirect_uri": redirect_uri,
     }
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.post(DISCORD_TOKEN_URL, data=data, headers=headers)
+    r = await client.post(DISCORD_TOKEN_URL, data=data, headers=headers, timeout=20)
     if r.status_code != 200:
         raise HTTPException(status_code=400, detail=f"Discord token exchange failed: {r.text}")
-    return r.json()["access_token"]
+    return orjson.loads(r.content)["access_token"]
 
 
-async def _fetch_discord_me(access_token: str) -> dict:
+async def _fetch_discord_me(client: httpx.AsyncClient, access_token: str) -> dict:
     headers = {"Authorization": f"Bearer {access_token}"}
-    async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.get(DISCORD_ME_URL, headers=headers)
+    r = await client.get(DISCORD_ME_URL, headers=headers, timeout=20)
     if r.status_code != 200:
         raise HTTPException(status_code=400, detail=f"Discord /me failed: {r.text}")
-    return r.json()
+    return orjson.loads(r.content)
 
 
 @router.get("/start")
@@ -64,7 +94,7 @@ async def discord_start(request: Request):
     if not (settings.discord_client_id and settings.discord_client_secret and settings.discord_redirect_uri):
         raise HTTPException(status_code=500, detail="Discord env vars missing (CLIENT_ID/SECRET/REDIRECT_URI)")
 
-    state = secrets.token_urlsafe(24)
+    state = _sign_state(settings.discord_client_secret)
     auth_url = _build_authorize_url(settings.discord_client_id, settings.discord_redirect_uri, state)
 
     resp = RedirectResponse(url=auth_url, status_code=302)
@@ -74,7 +104,7 @@ async def discord_start(request: Request):
         httponly=True,
         secure=settings.cookie_secure,
         samesite="lax",
-        max_age=10 * 60,
+        max_age=STATE_MAX_AGE,
     )
     return resp
 
@@ -85,39 +115,51 @@ async def discord_callback(
     code: str,
     state: str,
     db: AsyncSession = Depends(get_db),
+    http: httpx.AsyncClient = Depends(get_http),
 ):
     settings = get_settings()
 
-    cookie_state = request.cookies.get("discord_state")
-    if not cookie_state or cookie_state != state:
-        raise HTTPException(status_code=401, detail="Invalid state")
-
     if not (settings.discord_client_id and settings.discord_client_secret and settings.discord_redirect_uri):
         raise HTTPException(status_code=500, detail="Discord env vars missing")
 
+    cookie_state = request.cookies.get("discord_state")
+    if not cookie_state or not hmac.compare_digest(cookie_state.encode(), state.encode()):
+        raise HTTPException(status_code=401, detail="Invalid state")
+    if not _verify_state(settings.discord_client_secret, state):
+        raise HTTPException(status_code=401, detail="Invalid state")
+
     access_token = await _exchange_code_for_token(
+        http,
         code=code,
         client_id=settings.discord_client_id,
         client_secret=settings.discord_client_secret,
         redirect_uri=settings.discord_redirect_uri,
     )
-    me = await _fetch_discord_me(access_token)
+    me = await _fetch_discord_me(http, access_token)
 
     discord_user_id = str(me.get("id") or "")
-    discord_email = me.get("email")
+    # Stored lower-cased; ix_users_email_lower matches older mixed-case rows too.
+    discord_email = (me.get("email") or "").strip().lower()
 
     if not discord_user_id:
         raise HTTPException(status_code=400, detail="Discord user id missing")
     if not discord_email:
         raise HTTPException(status_code=400, detail="Discord email missing (ensure scope includes email)")
 
-    result = await db.execute(select(User).where(User.email == discord_email))
-    user = result.scalar_one_or_none()
-    if not user:
-        user = User(email=discord_email, access_level="free")
-        db.add(user)
-
-    user.discord_user_id = discord_user_id
+    # Create-or-link in one atomic statement (lower(users.email) is unique).
+    stmt = pg_insert(User).values(
+        email=discord_email,
+        access_level=AccessLevel.free,
+        discord_user_id=discord_user_id,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[func.lower(User.email)],
+        set_={
+            "discord_user_id": stmt.excluded.discord_user_id,
+            "updated_at": stmt.excluded.updated_at,
+        },
+    )
+    await db.execute(stmt)
     await db.commit()
 
     done_url = f"{settings.frontend_url}/discord/linked?success=1&discord_user_id={discord_user_id}"
@@ -1,67 +1,29 @@
 from __future__ import annotations
 
+import hashlib
+import hmac
+import time
 from typing import Any, Dict, Optional
 
+import orjson
 import stripe
-from fastapi import APIRouter, Depends, HTTPException, Request
-from sqlalchemy import text
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.database import get_db
+from app.database import get_webhook_db
 from app.config import get_settings
+from app.services.stripe_events import claim_event, enqueue_event
 
 router = APIRouter(prefix="/stripe", tags=["stripe"])
 
+# Constant webhook acks, encoded once. A fresh Response wraps them each time
+# since middleware may add headers to it.
+_ACK_RECEIVED = orjson.dumps({"ok": True, "received": True})
+_ACK_IDEMPOTENT = orjson.dumps({"ok": True, "idempotent": True})
 
-async def _set_user_premium(db: AsyncSession, discord_user_id: str):
-    await db.execute(
-        text("UPDATE users SET access_level='premium' WHERE discord_user_id=:id"),
-        {"id": discord_user_id},
-    )
-    await db.commit()
-
-
-async def _set_user_free(db: AsyncSession, discord_id: str):
-    await db.execute(
-        text("UPDATE users SET access_level='free' WHERE discord_user_id=:id"),
-        {"id": discord_user_id},
-    )
-    await db.commit()
-
-
-import os
-import httpx
-
-async def _grant_discord_role(discord_user_id: str):
-    bot_token = os.getenv("DISCORD_BOT_TOKEN")
-    guild_id = os.getenv("DISCORD_GUILD_ID")
-    role_id = os.getenv("DISCORD_PREMIUM_ROLE_ID")
-
-    if not bot_token or not guild_id or not role_id:
-        raise Exception("Missing Discord env vars")
+# Same default tolerance as stripe.Webhook.construct_event
+WEBHOOK_TOLERANCE = 300
 
-    url = f"https://discord.com/api/v10/guilds/{guild_id}/members/{discord_user_id}/roles/{role_id}"
-
-    headers = {
-        "Authorization": f"Bot {bot_token}"
-    }
-
-    async with httpx.AsyncClient(timeout=10) as client:
-        r = await client.put(url, headers=headers)
-
-    if r.status_code not in (200, 204):
-        raise Exception(f"Discord role grant failed: {r.status_code} {r.text}")
-
-    return True
-
-
-async def _revoke_discord_role(discord_user_id: str):
-    # TODO: koppla riktig revoke här
-    return True
-    
-# --------------------------------------------------
-# Helpers
-# --------------------------------------------------
 
 def _require_settings(settings):
     if not getattr(settings, "stripe_secret_key", None):
@@ -74,43 +36,49 @@ def _require_settings(settings):
         raise HTTPException(status_code=500, detail="FRONTEND_URL missing")
 
 
-async def _idempotency_check(db: AsyncSession, event_id: str) -> bool:
+def _parse_signature_header(sig_header: Optional[str]) -> tuple[str, list[bytes]]:
+    if not sig_header:
+        raise ValueError("Missing stripe-signature header")
+    t = ""
+    signatures: list[bytes] = []
+    # While a webhook secret is being rolled Stripe sends one v1 per secret.
+    for part in sig_header.split(","):
+        key, _, value = part.partition("=")
+        if key == "t":
+            t = value
+        elif key == "v1":
+            signatures.append(value.encode())
+    if not t.isdigit() or not signatures:
+        raise ValueError("Malformed stripe-signature header")
+    if abs(time.time() - int(t)) > WEBHOOK_TOLERANCE:
+        raise ValueError("Timestamp outside the tolerance zone")
+    return t, signatures
+
+
+async def _read_verified_body(request: Request, secret: str) -> bytearray:
+    # Stripe's scheme: v1 = hex(HMAC-SHA256(secret, f"{t}.{payload}")).
+    # Header checks run before any body bytes are read, and the HMAC is fed
+    # chunk by chunk as the body arrives.
+    t, signatures = _parse_signature_header(request.headers.get("stripe-signature"))
+    mac = hmac.new(secret.encode(), t.encode() + b".", hashlib.sha256)
+    body = bytearray()
+    async for chunk in request.stream():
+        mac.update(chunk)
+        body += chunk
+    expected = mac.hexdigest().encode()
+    if not any(hmac.compare_digest(expected, sig) for sig in signatures):
+        raise ValueError("No signatures found matching the expected signature for payload")
+    return body
+
+
+async def _read_json_body(request: Request) -> Dict[str, Any]:
     try:
-        await db.execute(
-            text("INSERT INTO stripe_events (id) VALUES (:id)"),
-            {"id": event_id},
-        )
-        await db.commit()
-        return False
-    except Exception as e:
-        print("WEBHOOK SIGNATURE ERROR:", repr(e))
-        raise HTTPException(status_code=400, detail=f"Webhook signature error:{str(e)}")
-        await db.rollback()
-        return True
-
-
-def _extract_discord_id(obj: Dict[str, Any]) -> Optional[str]:
-    if not obj:
-        return None
-
-    if obj.get("client_reference_id"):
-        return str(obj["client_reference_id"])
-
-    meta = obj.get("metadata") or {}
-    if meta.get("discord_id"):
-        return str(meta["discord_id"])
-
-    sub_details = obj.get("subscription_details") or {}
-    meta2 = sub_details.get("metadata") or {}
-    if meta2.get("discord_id"):
-        return str(meta2["discord_id"])
-
-    return None
-
-
-def _extract_plan(obj: Dict[str, Any]) -> Optional[str]:
-    meta = obj.get("metadata") or {}
-    return str(meta.get("plan")) if meta.get("plan") else None
+        payload = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="JSON object expected")
+    return payload
 
 
 # --------------------------------------------------
@@ -122,7 +90,6 @@ from fastapi.responses import RedirectResponse
 async def checkout_get(request: Request):
     settings = get_settings()
     _require_settings(settings)
-    stripe.api_key = settings.stripe_secret_key
 
     # Hämta discord_id från cookie (om du redan sätter den vid login)
     discord_id = request.cookies.get("discord_id")
@@ -131,7 +98,7 @@ async def checkout_get(request: Request):
     if not discord_id:
         raise HTTPException(status_code=400, detail="discord_id cookie missing")
 
-    session = stripe.checkout.Session.create(
+    session = await stripe.checkout.Session.create_async(
         mode="subscription",
         payment_method_types=["card"],
         line_items=[{"price": settings.stripe_price_id, "quantity": 1}],
@@ -150,9 +117,7 @@ async def create_checkout_session(request: Request):
     settings = get_settings()
     _require_settings(settings)
 
-    stripe.api_key = settings.stripe_secret_key
-
-    payload = await request.json()
+    payload = await _read_json_body(request)
 
     discord_id = payload.get("discord_id")   # 👈 LÄS FRÅN BODY
     plan = payload.get("plan", "premium_399")
@@ -160,7 +125,7 @@ async def create_checkout_session(request: Request):
     if not discord_id:
         raise HTTPException(status_code=400, detail="discord_id required")
 
-    session = stripe.checkout.Session.create(
+    session = await stripe.checkout.Session.create_async(
         mode="subscription",
         payment_method_types=["card"],
         line_items=[{"price": settings.stripe_price_id, "quantity": 1}],
@@ -191,15 +156,13 @@ async def create_customer_portal(request: Request):
     settings = get_settings()
     _require_settings(settings)
 
-    stripe.api_key = settings.stripe_secret_key
-
-    payload = await request.json()
+    payload = await _read_json_body(request)
     customer_id = payload.get("stripe_customer_id")
 
     if not customer_id:
         raise HTTPException(status_code=400, detail="stripe_customer_id required")
 
-    session = stripe.billing_portal.Session.create(
+    session = await stripe.billing_portal.Session.create_async(
         customer=str(customer_id),
         return_url=f"{settings.frontend_url}/account",
     )
@@ -211,108 +174,25 @@ async def create_customer_portal(request: Request):
 # Webhook
 # --------------------------------------------------
 
-@router.post("/webhook")
-async def stripe_webhook(request: Request, db: AsyncSession = Depends(get_db)):
+@router.post("/webhook", status_code=202)
+async def stripe_webhook(
+    request: Request,
+    db: AsyncSession = Depends(get_webhook_db),
+):
     settings = get_settings()
     _require_settings(settings)
 
-    stripe.api_key = settings.stripe_secret_key
-
-    payload = await request.body()
-    sig_header = request.headers.get("stripe-signature")
-
     try:
-        event = stripe.Webhook.construct_event(
-            payload=payload,
-            sig_header=sig_header,
-            secret=settings.stripe_webhook_secret,
-        )
+        payload = await _read_verified_body(request, settings.stripe_webhook_secret)
+        event = orjson.loads(payload)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Webhook signature error: {str(e)}")
 
     event_id = event.get("id")
     if event_id:
-        already = await _idempotency_check(db, event_id)
-        if already:
-            return {"ok": True, "idempotent": True}
-
-    event_type = event.get("type")
-    obj = (event.get("data") or {}).get("object") or {}
-
-    # --------------------------------------------------
-    # 1️⃣ Checkout completed
-    # --------------------------------------------------
-    if event_type == "checkout.session.completed":
-        discord_id = _extract_discord_id(obj)
-        stripe_customer_id = obj.get("customer")
-        plan = _extract_plan(obj) or "premium_399"
-
-        if not discord_id:
-            return {"ok": True, "note": "No discord_id in checkout"}
-
-        await _set_user_premium(db, str(discord_id))
-
-        try:
-            await _grant_discord_role(str(discord_id))
-            return {"ok": True, "granted": True}
-        except Exception as e:
-            return {"ok": True, "granted": False, "error": str(e)}
-
-    # --------------------------------------------------
-    # 2️⃣ Invoice paid (renewal)
-    # --------------------------------------------------
-    if event_type in ("invoice.paid", "invoice.payment_succeeded"):
-        stripe_customer_id = obj.get("customer")
-        discord_user_id = _extract_discord_id(obj)
-        subscription_id = obj.get("subscription")
-        plan = None
-
-        if not discord_user_id and subscription_id:
-            try:
-                sub = stripe.Subscription.retrieve(subscription_id)
-                discord_user_id = _extract_discord_id(sub)
-                
-            except Exception:
-                pass
-
-        if not discord_user_id:
-            return {"ok": True, "note": "Invoice paid but no discord_user_id"}
-
-        await _set_user_premium(db, str(discord_user_id))
-
-        try:
-            await _grant_discord_role(str(discord_user_id))
-        except Exception:
-            pass
-
-        return {"ok": True, "invoice": True}
-
-    # --------------------------------------------------
-    # 3️⃣ Subscription updated / deleted
-    # --------------------------------------------------
-    if event_type in ("customer.subscription.deleted", "customer.subscription.updated"):
-        discord_id = _extract_discord_id(obj)
-        stripe_customer_id = obj.get("customer")
-        status = obj.get("status")
-
-        if not discord_user_id:
-            return {"ok": True}
-
-        if event_type == "customer.subscription.deleted" or status in ("canceled", "unpaid"):
-            await _set_user_free(db, str(discord_user_id))
-            try:
-                await _revoke_discord_role(str(discord_user_id))
-            except Exception:
-                pass
-            return {"ok": True, "revoked": True}
-
-        await _set_user_premium(db, str(discord_user_id), str(stripe_customer_id), access_level=_extract_plan(obj) or "premium_399")
-
-        try:
-            await _grant_discord_role(str(discord_user_id))
-        except Exception:
-            pass
-
-        return {"ok": True, "updated": True}
-
-    return {"ok": True, "ignored": event_type}
+        if not await claim_event(db, event_id):
+            return Response(content=_ACK_IDEMPOTENT, status_code=202, media_type="application/json")
+
+    # Ack Stripe now; DB updates and role changes run on the event worker.
+    enqueue_event(event)
+    return Response(content=_ACK_RECEIVED, status_code=202, media_type="application/json")
@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+from dataclasses import dataclass
+from types import MappingProxyType
+
+import httpx
+
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+# The bot token is fixed for the life of the process.
+_BOT_HEADERS = MappingProxyType({"Authorization": f"Bot {get_settings().discord_bot_token}"})
+
+GRANT = "grant"
+REVOKE = "revoke"
+
+# discord_user_id -> latest requested action. A user is queued at most once;
+# repeated webhook deliveries only overwrite the action it will resolve to.
+_desired: dict[str, str] = {}
+_role_queue: asyncio.Queue[str] = asyncio.Queue()
+# discord_user_id -> failed attempts so far for the action being retried.
+_attempts: dict[str, int] = {}
+# discord_user_id -> (timer, action) for retries waiting out their backoff.
+_retries: dict[str, tuple[asyncio.TimerHandle, str]] = {}
+# Set once shutdown starts draining; also cuts short a 429 wait in progress.
+_draining = asyncio.Event()
+
+ROLE_MAX_ATTEMPTS = 5
+ROLE_BACKOFF_MAX = 60.0
+
+
+@dataclass(slots=True)
+class RoleResult:
+    ok: bool
+    status: int
+    retry_after: float | None = None
+
+    @property
+    def retryable(self) -> bool:
+        return self.status == 429 or self.status >= 500
+
+
+class RoleRequestFailed(Exception):
+    def __init__(self, message: str, result: RoleResult):
+        super().__init__(message)
+        self.result = result
+
+
+def _parse_retry_after(r: httpx.Response) -> float | None:
+    if r.status_code != 429:
+        return None
+    try:
+        retry_after = float(r.headers.get("Retry-After", "1"))
+    except ValueError:
+        return 1.0
+    return retry_after if math.isfinite(retry_after) and retry_after >= 0 else 1.0
+
+
+async def _respect_bucket(r: httpx.Response) -> None:
+    # The worker is the only caller, so waiting out an exhausted bucket here
+    # keeps the next request from drawing a 429 in the first place. A 429 is
+    # skipped: role_worker already waits out its Retry-After.
+    if r.status_code == 429 or r.headers.get("X-RateLimit-Remaining") != "0":
+        return
+    try:
+        reset_after = float(r.headers.get("X-RateLimit-Reset-After", "0"))
+    except ValueError:
+        return
+    if reset_after > 0:
+        await asyncio.sleep(min(reset_after, ROLE_BACKOFF_MAX))
+
+
+async def _role_request(
+    client: httpx.AsyncClient,
+    method: str,
+    discord_user_id: str,
+    ok: tuple[int, ...],
+) -> RoleResult:
+    settings = get_settings()
+    bot_token = settings.discord_bot_token
+    guild_id = settings.discord_guild_id
+    role_id = settings.discord_premium_role_id
+
+    if not bot_token or not guild_id or not role_id:
+        raise Exception("Missing Discord env vars")
+
+    url = f"https://discord.com/api/v10/guilds/{guild_id}/members/{discord_user_id}/roles/{role_id}"
+
+    r = await client.request(method, url, headers=_BOT_HEADERS)
+    await _respect_bucket(r)
+    return RoleResult(ok=r.status_code in ok, status=r.status_code, retry_after=_parse_retry_after(r))
+
+
+async def _grant_discord_role(client: httpx.AsyncClient, discord_user_id: str) -> RoleResult:
+    result = await _role_request(client, "PUT", discord_user_id, (200, 204))
+    if not result.ok:
+        raise RoleRequestFailed(f"Discord role grant failed: {result.status}", result)
+    return result
+
+
+async def _revoke_discord_role(client: httpx.AsyncClient, discord_user_id: str) -> RoleResult:
+    # 404 = member already left the guild, so there is no role to remove
+    result = await _role_request(client, "DELETE", discord_user_id, (200, 204, 404))
+    if not result.ok:
+        raise RoleRequestFailed(f"Discord role revoke failed: {result.status}", result)
+    return result
+
+
+def _queue(action: str, discord_user_id: str) -> None:
+    if discord_user_id not in _desired:
+        _role_queue.put_nowait(discord_user_id)
+    _desired[discord_user_id] = action
+
+
+def enqueue_role_change(action: str, discord_user_id: str) -> None:
+    # A fresh request supersedes any retry still pending for this user.
+    pending = _retries.pop(discord_user_id, None)
+    if pending is not None:
+        pending[0].cancel()
+    _attempts.pop(discord_user_id, None)
+    _queue(action, discord_user_id)
+
+
+def _fire_retry(action: str, discord_user_id: str) -> None:
+    _retries.pop(discord_user_id, None)
+    _queue(action, discord_user_id)
+
+
+def _retry_later(action: str, discord_user_id: str, attempt: int, delay: float) -> None:
+    _attempts[discord_user_id] = attempt
+    handle = asyncio.get_running_loop().call_later(delay, _fire_retry, action, discord_user_id)
+    _retries[discord_user_id] = (handle, action)
+
+
+async def drain_role_changes() -> None:
+    _draining.set()
+    # Called on shutdown: retries still backing off get one last attempt now.
+    for discord_user_id in list(_retries):
+        handle, action = _retries.pop(discord_user_id)
+        handle.cancel()
+        _queue(action, discord_user_id)
+    await _role_queue.join()
+
+
+def _retry_delay(e: Exception, attempt: int) -> float | None:
+    if isinstance(e, RoleRequestFailed):
+        retryable = e.result.retryable
+    else:
+        retryable = isinstance(e, httpx.TransportError)
+    if not retryable or attempt >= ROLE_MAX_ATTEMPTS:
+        return None
+    if isinstance(e, RoleRequestFailed) and e.result.retry_after is not None:
+        # Global limits can ask for minutes; the worker sleeps this inline.
+        return min(e.result.retry_after, ROLE_BACKOFF_MAX)
+    return min(2.0 ** attempt, ROLE_BACKOFF_MAX)
+
+
+async def role_worker(client: httpx.AsyncClient) -> None:
+    while True:
+        discord_user_id = await _role_queue.get()
+        action = _desired.pop(discord_user_id)
+        try:
+            if action == GRANT:
+                await _grant_discord_role(client, discord_user_id)
+            else:
+                await _revoke_discord_role(client, discord_user_id)
+            _attempts.pop(discord_user_id, None)
+        except Exception as e:
+            attempt = _attempts.pop(discord_user_id, 0) + 1
+            delay = _retry_delay(e, attempt)
+            if delay is None or _draining.is_set():
+                # Shutdown gets no retries: a 429 wait would eat the drain timeout.
+                logger.warning("Discord role %s failed for %s: %s", action, discord_user_id, e)
+            elif isinstance(e, RoleRequestFailed) and e.result.status == 429:
+                logger.info("Discord role %s for %s rate limited for %.1fs", action, discord_user_id, delay)
+                # A 429 applies to the whole route, so the worker waits it out
+                # rather than hammering Discord with the next user.
+                try:
+                    await asyncio.wait_for(_draining.wait(), delay)
+                    logger.warning("Discord role %s for %s dropped on shutdown", action, discord_user_id)
+                except asyncio.TimeoutError:
+                    # A newer action queued meanwhile supersedes this retry.
+                    if discord_user_id not in _desired:
+                        _attempts[discord_user_id] = attempt
+                        _queue(action, discord_user_id)
+            else:
+                # Outages and transport errors are per request; back off this
+                # user only and keep draining everyone else's changes.
+                logger.info("Discord role %s for %s retrying in %.1fs: %s", action, discord_user_id, delay, e)
+                _retry_later(action, discord_user_id, attempt, delay)
+        finally:
+            _role_queue.task_done()
@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+import httpx
+from fastapi import Request
+
+
+def create_http_client() -> httpx.AsyncClient:
+    # One pooled client per process: keep-alive connections to discord.com /
+    # api.stripe.com are reused instead of paying TCP+TLS setup per call.
+    # retries only covers connect failures (DNS flaps, refused/reset
+    # connects), so it never replays a request Discord already received.
+    # limits must sit on the transport once one is passed in.
+    return httpx.AsyncClient(
+        timeout=10,
+        transport=httpx.AsyncHTTPTransport(
+            retries=2,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        ),
+    )
+
+
+def get_http(request: Request) -> httpx.AsyncClient:
+    return request.app.state.http
@@ -0,0 +1,287 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import stripe
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import webhook_session_maker
+from app.models import AccessLevel
+from app.services.discord import GRANT, REVOKE, enqueue_role_change
+
+logger = logging.getLogger(__name__)
+
+_SQL_SET_ACCESS = text(
+    "UPDATE users SET access_level=:lvl, stripe_customer_id=COALESCE(:cid, stripe_customer_id), updated_at=now() "
+    "WHERE discord_user_id=:id"
+)
+
+_SQL_CLAIM_EVENT = text("INSERT INTO stripe_events (id) VALUES (:id) ON CONFLICT (id) DO NOTHING")
+_SQL_RELEASE_EVENT = text("DELETE FROM stripe_events WHERE id = ANY(:ids)")
+_SQL_MARK_PROCESSED = text("UPDATE stripe_events SET processed_at = now() WHERE id = :id")
+# Re-stamping received_at hands each stale claim to one worker only.
+_SQL_CLAIM_STALE = text(
+    "UPDATE stripe_events SET received_at = now() "
+    "WHERE processed_at IS NULL AND received_at < now() - make_interval(secs => :age) "
+    "RETURNING id"
+)
+
+EVENT_MAX_ATTEMPTS = 5
+EVENT_BACKOFF_MAX = 60.0
+# Seconds a claimed event may stay unprocessed before another sweep replays
+# it; well past the time its own worker spends retrying it.
+EVENT_RECOVERY_AGE = 300.0
+
+# Event ids this worker has already claimed, newest last. Redeliveries that
+# land on the same worker are answered without a DB round trip; the
+# stripe_events table stays the source of truth across workers.
+_SEEN_EVENTS: OrderedDict[str, None] = OrderedDict()
+_SEEN_EVENTS_MAX = 10_000
+
+# Verified, claimed Stripe events waiting to be applied, with the number of
+# failed attempts so far. The webhook route only acks; the worker does the DB
+# writes and queues the role changes.
+_event_queue: asyncio.Queue[tuple[Dict[str, Any], int]] = asyncio.Queue()
+# token -> (timer, event, attempt) for failed events waiting out their backoff.
+_retries: dict[int, tuple[asyncio.TimerHandle, Dict[str, Any], int]] = {}
+_retry_tokens = itertools.count()
+# Ids of acked events this process has not yet applied or given up on.
+_unfinished: set[str] = set()
+_draining = False
+
+
+async def _set_access_level(
+    db: AsyncSession,
+    discord_user_id: str,
+    level: AccessLevel,
+    stripe_customer_id: Optional[str] = None,
+) -> None:
+    await db.execute(
+        _SQL_SET_ACCESS,
+        {"id": discord_user_id, "lvl": level.value, "cid": stripe_customer_id},
+    )
+    await db.commit()
+
+
+def _extract_discord_id(obj: Dict[str, Any]) -> Optional[str]:
+    if not obj:
+        return None
+
+    if obj.get("client_reference_id"):
+        return str(obj["client_reference_id"])
+
+    meta = obj.get("metadata") or {}
+    if meta.get("discord_id"):
+        return str(meta["discord_id"])
+
+    sub_details = obj.get("subscription_details") or {}
+    meta2 = sub_details.get("metadata") or {}
+    if meta2.get("discord_id"):
+        return str(meta2["discord_id"])
+
+    return None
+
+
+def _extract_plan(obj: Dict[str, Any]) -> Optional[str]:
+    meta = obj.get("metadata") or {}
+    return str(meta.get("plan")) if meta.get("plan") else None
+
+
+async def _handle_checkout_completed(db: AsyncSession, obj: Dict[str, Any], discord_id: Optional[str]) -> None:
+    if not discord_id:
+        logger.info("checkout.session.completed without discord_id")
+        return
+
+    await _set_access_level(db, discord_id, AccessLevel.premium, obj.get("customer"))
+    enqueue_role_change(GRANT, discord_id)
+
+
+async def _handle_invoice_paid(db: AsyncSession, obj: Dict[str, Any], discord_id: Optional[str]) -> None:
+    # Renewals: the invoice itself often lacks our metadata, the subscription has it.
+    subscription_id = obj.get("subscription")
+
+    if not discord_id and subscription_id:
+        try:
+            sub = await stripe.Subscription.retrieve_async(subscription_id)
+            discord_id = _extract_discord_id(sub)
+        except Exception as e:
+            logger.warning("Subscription lookup failed for %s: %s", subscription_id, e)
+
+    if not discord_id:
+        logger.info("invoice %s without discord_id", obj.get("id"))
+        return
+
+    await _set_access_level(db, discord_id, AccessLevel.premium, obj.get("customer"))
+    enqueue_role_change(GRANT, discord_id)
+
+
+async def _handle_subscription_updated(db: AsyncSession, obj: Dict[str, Any], discord_id: Optional[str]) -> None:
+    if not discord_id:
+        return
+
+    if obj.get("status") in ("canceled", "unpaid"):
+        await _set_access_level(db, discord_id, AccessLevel.free, obj.get("customer"))
+        enqueue_role_change(REVOKE, discord_id)
+        return
+
+    await _set_access_level(db, discord_id, AccessLevel.premium, obj.get("customer"))
+    enqueue_role_change(GRANT, discord_id)
+
+
+async def _handle_subscription_deleted(db: AsyncSession, obj: Dict[str, Any], discord_id: Optional[str]) -> None:
+    if not discord_id:
+        return
+
+    await _set_access_level(db, discord_id, AccessLevel.free, obj.get("customer"))
+    enqueue_role_change(REVOKE, discord_id)
+
+
+_HANDLERS: Dict[str, Callable[[AsyncSession, Dict[str, Any], Optional[str]], Awaitable[None]]] = {
+    "checkout.session.completed": _handle_checkout_completed,
+    "invoice.paid": _handle_invoice_paid,
+    "invoice.payment_succeeded": _handle_invoice_paid,
+    "customer.subscription.updated": _handle_subscription_updated,
+    "customer.subscription.deleted": _handle_subscription_deleted,
+}
+
+
+async def _process_event(event: Dict[str, Any]) -> None:
+    handler = _HANDLERS.get(event.get("type"))
+
+    async with webhook_session_maker() as db:
+        if handler is not None:
+            obj = (event.get("data") or {}).get("object") or {}
+            # Resolved once here; handlers only fall back to Stripe when it is missing.
+            await handler(db, obj, _extract_discord_id(obj))
+        if event.get("id"):
+            # Marked last: a crash before this replays the event, and every
+            # handler is safe to apply twice.
+            await db.execute(_SQL_MARK_PROCESSED, {"id": event["id"]})
+            await db.commit()
+
+
+def _remember_event(event_id: str) -> None:
+    _SEEN_EVENTS[event_id] = None
+    if len(_SEEN_EVENTS) > _SEEN_EVENTS_MAX:
+        _SEEN_EVENTS.popitem(last=False)
+
+
+# False means the event id was already claimed.
+async def claim_event(db: AsyncSession, event_id: str) -> bool:
+    if event_id in _SEEN_EVENTS:
+        return False
+    # A redelivery hits the primary key and inserts nothing.
+    result = await db.execute(_SQL_CLAIM_EVENT, {"id": event_id})
+    await db.commit()
+    _remember_event(event_id)
+    return result.rowcount == 1
+
+
+async def _release_events(event_ids: list[str]) -> None:
+    # Lets a manual resend from the Stripe dashboard be applied again.
+    for event_id in event_ids:
+        _SEEN_EVENTS.pop(event_id, None)
+    try:
+        async with webhook_session_maker() as db:
+            await db.execute(_SQL_RELEASE_EVENT, {"ids": event_ids})
+            await db.commit()
+    except Exception:
+        logger.exception("Releasing Stripe events %s failed", event_ids)
+
+
+def enqueue_event(event: Dict[str, Any], attempt: int = 0) -> None:
+    if event.get("id"):
+        _unfinished.add(event["id"])
+    _event_queue.put_nowait((event, attempt))
+
+
+def _fire_retry(token: int) -> None:
+    _, event, attempt = _retries.pop(token)
+    enqueue_event(event, attempt)
+
+
+def _retry_later(event: Dict[str, Any], attempt: int) -> None:
+    token = next(_retry_tokens)
+    delay = min(2.0 ** attempt, EVENT_BACKOFF_MAX)
+    handle = asyncio.get_running_loop().call_later(delay, _fire_retry, token)
+    _retries[token] = (handle, event, attempt)
+
+
+async def drain_events() -> None:
+    global _draining
+    _draining = True
+    # Called on shutdown: retries still backing off run now rather than
+    # waiting for another worker's recovery sweep.
+    for token in list(_retries):
+        handle, event, attempt = _retries.pop(token)
+        handle.cancel()
+        enqueue_event(event, attempt)
+    await _event_queue.join()
+
+
+def log_unfinished_events() -> None:
+    # Shutdown ran out of time. The claims stay unprocessed, so a recovery
+    # sweep on a running worker replays them.
+    if _unfinished:
+        logger.warning("Stripe events left for recovery: %s", ", ".join(sorted(_unfinished)))
+
+
+async def _recover_stale_events() -> None:
+    async with webhook_session_maker() as db:
+        result = await db.execute(_SQL_CLAIM_STALE, {"age": EVENT_RECOVERY_AGE})
+        event_ids = list(result.scalars())
+        await db.commit()
+    for event_id in event_ids:
+        if event_id in _unfinished:
+            # Still retrying in this process.
+            continue
+        try:
+            event = await stripe.Event.retrieve_async(event_id)
+        except stripe.InvalidRequestError:
+            # Gone from Stripe (older than 30 days); nothing left to replay.
+            logger.exception("Unprocessed Stripe event %s cannot be fetched, dropping it", event_id)
+            await _release_events([event_id])
+            continue
+        except Exception:
+            logger.warning("Fetching unprocessed Stripe event %s failed", event_id, exc_info=True)
+            continue
+        logger.warning("Replaying unprocessed Stripe event %s (%s)", event_id, event.get("type"))
+        enqueue_event(event)
+
+
+async def recover_events() -> None:
+    # An acked event lives only in memory until it is applied, and Stripe
+    # never redelivers a 2xx. Claims a dead worker left unprocessed are
+    # fetched from Stripe and replayed here.
+    while True:
+        try:
+            await _recover_stale_events()
+        except Exception:
+            logger.exception("Recovering unprocessed Stripe events failed")
+        await asyncio.sleep(EVENT_RECOVERY_AGE)
+
+
+async def event_worker() -> None:
+    while True:
+        event, attempt = await _event_queue.get()
+        try:
+            await _process_event(event)
+            _unfinished.discard(event.get("id"))
+        except Exception:
+            attempt += 1
+            event_id = event.get("id")
+            if attempt < EVENT_MAX_ATTEMPTS and not _draining:
+                logger.warning("Stripe event %s (%s) failed, attempt %d", event_id, event.get("type"), attempt, exc_info=True)
+                _retry_later(event, attempt)
+            else:
+                logger.exception("Stripe event %s (%s) dropped after %d attempts", event_id, event.get("type"), attempt)
+                if event_id:
+                    _unfinished.discard(event_id)
+                    await _release_events([event_id])
+        finally:
+            _event_queue.task_done()
@@ -0,0 +1,14 @@
+-- One-off index changes for databases whose users table predates them.
+-- create_all never alters an existing table, so these are applied by hand,
+-- outside a transaction (CONCURRENTLY keeps writes flowing while they build):
+--   psql "$DATABASE_URL" -f migrations/001_users_indexes.sql
+-- Merge case-only duplicate emails first (query in replit.md) or the unique
+-- index build fails. A failed CONCURRENTLY build leaves an invalid index:
+-- DROP INDEX CONCURRENTLY ix_users_email_lower before running this again.
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_users_email_lower ON users (lower(email));
+
+-- The partial discord_user_id index replaces the full one the column used
+-- to declare; build it before dropping the old index.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_discord_user_id_partial ON users (discord_user_id) WHERE discord_user_id IS NOT NULL;
+DROP INDEX CONCURRENTLY IF EXISTS ix_users_discord_user_id;
@@ -0,0 +1,8 @@
+-- Records which claimed Stripe events were applied, so events acked but lost
+-- to a crash can be replayed. Run right before deploying the code that sets
+-- it: rows claimed until then were handled by the old code and count as done.
+--   psql "$DATABASE_URL" -f migrations/002_stripe_events_processed_at.sql
+
+ALTER TABLE stripe_events ADD COLUMN IF NOT EXISTS received_at timestamptz NOT NULL DEFAULT now();
+ALTER TABLE stripe_events ADD COLUMN IF NOT EXISTS processed_at timestamptz;
+UPDATE stripe_events SET processed_at = received_at WHERE processed_at IS NULL;
@@ -0,0 +1,55 @@
+import time
+
+from app.routers.discord_routes import STATE_MAX_AGE, _sign_state, _verify_state
+
+SECRET = "discord-client-secret"
+
+
+def test_fresh_state_verifies():
+    assert _verify_state(SECRET, _sign_state(SECRET))
+
+
+def test_states_are_unique():
+    assert _sign_state(SECRET) != _sign_state(SECRET)
+
+
+def test_expired_state_rejected(monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now - STATE_MAX_AGE - 1)
+    state = _sign_state(SECRET)
+    monkeypatch.setattr(time, "time", lambda: now)
+    assert not _verify_state(SECRET, state)
+
+
+def test_state_at_max_age_still_valid(monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    state = _sign_state(SECRET)
+    monkeypatch.setattr(time, "time", lambda: now + STATE_MAX_AGE - 1)
+    assert _verify_state(SECRET, state)
+
+
+def test_wrong_secret_rejected():
+    assert not _verify_state("other-secret", _sign_state(SECRET))
+
+
+def test_tampered_nonce_rejected():
+    nonce, issued_at, sig = _sign_state(SECRET).split(".")
+    assert not _verify_state(SECRET, f"{nonce}x.{issued_at}.{sig}")
+
+
+def test_tampered_timestamp_rejected():
+    # Pushing issued_at forward would extend the state's lifetime.
+    nonce, issued_at, sig = _sign_state(SECRET).split(".")
+    assert not _verify_state(SECRET, f"{nonce}.{int(issued_at) + 3600}.{sig}")
+
+
+def test_tampered_signature_rejected():
+    state = _sign_state(SECRET)
+    flipped = "0" if state[-1] != "0" else "1"
+    assert not _verify_state(SECRET, state[:-1] + flipped)
+
+
+def test_malformed_states_rejected():
+    for state in ("", ".", "abc", "a.b", "a.notanumber.sig"):
+        assert not _verify_state(SECRET, state)
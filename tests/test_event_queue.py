@@ -0,0 +1,154 @@
+import asyncio
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+import stripe
+
+from app.services import stripe_events
+from app.services.stripe_events import (
+    EVENT_MAX_ATTEMPTS,
+    _process_event,
+    _recover_stale_events,
+    _retry_later,
+    drain_events,
+    enqueue_event,
+    event_worker,
+)
+
+EVENT = {"id": "evt_1", "type": "invoice.paid", "data": {"object": {}}}
+
+
+class FakeSession:
+    def __init__(self, ids=()):
+        self.ids = list(ids)
+        self.executed = []
+        self.commits = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, stmt, params=None):
+        self.executed.append((str(stmt), params))
+        return SimpleNamespace(scalars=lambda: self.ids)
+
+    async def commit(self):
+        self.commits += 1
+
+
+@pytest.fixture(autouse=True)
+def fresh_queue(monkeypatch):
+    # Module state is per process; each test gets its own queue and loop.
+    monkeypatch.setattr(stripe_events, "_event_queue", asyncio.Queue())
+    monkeypatch.setattr(stripe_events, "_retries", {})
+    monkeypatch.setattr(stripe_events, "_unfinished", set())
+    monkeypatch.setattr(stripe_events, "_draining", False)
+    monkeypatch.setattr(stripe_events, "_SEEN_EVENTS", OrderedDict())
+
+
+@pytest.fixture
+def released(monkeypatch):
+    calls = []
+
+    async def release(event_ids):
+        calls.append(event_ids)
+
+    monkeypatch.setattr(stripe_events, "_release_events", release)
+    return calls
+
+
+def _stub_process(monkeypatch, fail=False):
+    processed = []
+
+    async def process(event):
+        if fail:
+            raise RuntimeError("database unavailable")
+        processed.append(event["id"])
+
+    monkeypatch.setattr(stripe_events, "_process_event", process)
+    return processed
+
+
+def test_failed_event_is_retried_with_backoff(monkeypatch, released):
+    _stub_process(monkeypatch, fail=True)
+
+    async def run():
+        worker = asyncio.create_task(event_worker())
+        enqueue_event(EVENT)
+        await stripe_events._event_queue.join()
+        worker.cancel()
+        [(handle, event, attempt)] = stripe_events._retries.values()
+        handle.cancel()
+        return event, attempt, handle.when() - asyncio.get_running_loop().time()
+
+    event, attempt, delay = asyncio.run(run())
+    assert event is EVENT
+    assert attempt == 1
+    assert 1.5 < delay <= 2.0
+    assert stripe_events._unfinished == {"evt_1"}
+    assert released == []
+
+
+def test_event_dropped_and_released_after_max_attempts(monkeypatch, released):
+    _stub_process(monkeypatch, fail=True)
+
+    async def run():
+        worker = asyncio.create_task(event_worker())
+        enqueue_event(EVENT, EVENT_MAX_ATTEMPTS - 1)
+        await stripe_events._event_queue.join()
+        worker.cancel()
+
+    asyncio.run(run())
+    assert released == [["evt_1"]]
+    assert not stripe_events._retries
+    assert not stripe_events._unfinished
+
+
+def test_drain_runs_pending_retries(monkeypatch):
+    processed = _stub_process(monkeypatch)
+
+    async def run():
+        worker = asyncio.create_task(event_worker())
+        _retry_later(EVENT, 3)
+        await asyncio.wait_for(drain_events(), 1)
+        worker.cancel()
+
+    asyncio.run(run())
+    assert processed == ["evt_1"]
+    assert not stripe_events._retries
+    assert not stripe_events._unfinished
+
+
+def test_unhandled_event_is_marked_processed(monkeypatch):
+    session = FakeSession()
+    monkeypatch.setattr(stripe_events, "webhook_session_maker", lambda: session)
+
+    asyncio.run(_process_event({"id": "evt_2", "type": "customer.created"}))
+    assert [params for _, params in session.executed] == [{"id": "evt_2"}]
+    assert "processed_at" in session.executed[0][0]
+    assert session.commits == 1
+
+
+def test_recovery_replays_stale_claims(monkeypatch, released):
+    monkeypatch.setattr(stripe_events, "webhook_session_maker", lambda: FakeSession(["evt_1", "evt_2", "evt_3"]))
+    # evt_2 is still retrying in this process.
+    stripe_events._unfinished.add("evt_2")
+    fetched = []
+
+    async def retrieve(event_id):
+        fetched.append(event_id)
+        if event_id == "evt_3":
+            raise stripe.InvalidRequestError("No such event", "id")
+        return stripe.Event.construct_from({"id": event_id, "type": "invoice.paid"}, "sk_test")
+
+    monkeypatch.setattr(stripe.Event, "retrieve_async", retrieve)
+
+    asyncio.run(_recover_stale_events())
+    assert fetched == ["evt_1", "evt_3"]
+    event, attempt = stripe_events._event_queue.get_nowait()
+    assert (event["id"], attempt) == ("evt_1", 0)
+    assert stripe_events._event_queue.empty()
+    assert released == [["evt_3"]]
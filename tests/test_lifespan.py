@@ -0,0 +1,33 @@
+import asyncio
+import logging
+
+import pytest
+
+from app import main
+
+
+@pytest.fixture(autouse=True)
+def root_handlers():
+    yield
+    logging.getLogger().removeHandler(main._log_handler)
+
+
+def test_repeated_logging_setup_adds_one_handler():
+    main._configure_logging()
+    main._configure_logging()
+    assert logging.getLogger().handlers.count(main._log_handler) == 1
+
+
+def test_failed_startup_stops_log_listener(monkeypatch):
+    async def init_db():
+        raise ConnectionRefusedError("database unreachable")
+
+    monkeypatch.setattr(main, "init_db", init_db)
+
+    async def run():
+        async with main.lifespan(main.app):
+            pass
+
+    with pytest.raises(ConnectionRefusedError):
+        asyncio.run(run())
+    assert main._log_listener._thread is None
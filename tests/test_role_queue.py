@@ -0,0 +1,102 @@
+import asyncio
+import dataclasses
+
+import httpx
+import pytest
+
+from app.services import discord
+from app.services.discord import (
+    GRANT,
+    REVOKE,
+    ROLE_BACKOFF_MAX,
+    RoleRequestFailed,
+    RoleResult,
+    _parse_retry_after,
+    _retry_delay,
+    _retry_later,
+    drain_role_changes,
+    enqueue_role_change,
+    role_worker,
+)
+
+
+@pytest.fixture(autouse=True)
+def fresh_queue(monkeypatch):
+    # Module state is per process; each test gets its own queue and loop.
+    monkeypatch.setattr(discord, "_desired", {})
+    monkeypatch.setattr(discord, "_role_queue", asyncio.Queue())
+    monkeypatch.setattr(discord, "_attempts", {})
+    monkeypatch.setattr(discord, "_retries", {})
+    monkeypatch.setattr(discord, "_draining", asyncio.Event())
+    settings = dataclasses.replace(
+        discord.get_settings(),
+        discord_bot_token="token",
+        discord_guild_id="guild",
+        discord_premium_role_id="role",
+    )
+    monkeypatch.setattr(discord, "get_settings", lambda: settings)
+
+
+def _client(handler):
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_retry_after_is_capped():
+    e = RoleRequestFailed("rate limited", RoleResult(ok=False, status=429, retry_after=3600.0))
+    assert _retry_delay(e, 1) == ROLE_BACKOFF_MAX
+
+
+@pytest.mark.parametrize("value", ["soon", "nan", "inf", "-5"])
+def test_malformed_retry_after_falls_back(value):
+    assert _parse_retry_after(httpx.Response(429, headers={"Retry-After": value})) == 1.0
+
+
+def test_drain_cuts_a_rate_limit_wait_short():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(429, headers={"Retry-After": "30"})
+
+    async def run():
+        async with _client(handler) as client:
+            worker = asyncio.create_task(role_worker(client))
+            enqueue_role_change(GRANT, "u1")
+            await asyncio.wait_for(drain_role_changes(), 1)
+            worker.cancel()
+
+    asyncio.run(run())
+    assert len(calls) == 1
+    assert not discord._desired and not discord._retries
+
+
+def test_newer_change_cancels_pending_retry():
+    async def run():
+        _retry_later(REVOKE, "u1", 2, 30)
+        handle, _ = discord._retries["u1"]
+        enqueue_role_change(GRANT, "u1")
+        return handle
+
+    handle = asyncio.run(run())
+    assert handle.cancelled()
+    assert not discord._retries and not discord._attempts
+    assert discord._desired == {"u1": GRANT}
+
+
+def test_drain_runs_pending_retries():
+    calls = []
+
+    def handler(request):
+        calls.append(request.method)
+        return httpx.Response(204)
+
+    async def run():
+        async with _client(handler) as client:
+            worker = asyncio.create_task(role_worker(client))
+            _retry_later(REVOKE, "u1", 1, 30)
+            await asyncio.wait_for(drain_role_changes(), 1)
+            worker.cancel()
+
+    asyncio.run(run())
+    assert calls == ["DELETE"]
+    assert not discord._retries and not discord._attempts
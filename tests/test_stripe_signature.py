@@ -0,0 +1,113 @@
+import asyncio
+import hashlib
+import hmac
+import time
+
+import pytest
+import stripe
+from starlette.requests import Request
+
+from app.routers.stripe_routes import WEBHOOK_TOLERANCE, _parse_signature_header, _read_verified_body
+
+SECRET = "whsec_test_secret"
+PAYLOAD = b'{"id":"evt_test_webhook","object":"event","type":"checkout.session.completed"}'
+# Precomputed hex(HMAC-SHA256(SECRET, b"1700000000." + PAYLOAD)).
+KNOWN_T = 1700000000
+KNOWN_V1 = "1fa73ff7286785daa8168695a709e92ce31d02a9202648cb27a1c5f2e233f517"
+
+
+def _sign(payload: bytes, t: int, secret: str = SECRET) -> str:
+    return hmac.new(secret.encode(), f"{t}.".encode() + payload, hashlib.sha256).hexdigest()
+
+
+def _request(body: bytes, sig_header: str | None, chunk_size: int = 16) -> Request:
+    headers = [] if sig_header is None else [(b"stripe-signature", sig_header.encode())]
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] or [b""]
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+        for i, chunk in enumerate(chunks)
+    ]
+
+    async def receive():
+        return messages.pop(0)
+
+    scope = {"type": "http", "method": "POST", "path": "/stripe/webhook", "headers": headers}
+    return Request(scope, receive)
+
+
+def _verify(body: bytes, sig_header: str | None) -> bytearray:
+    return asyncio.run(_read_verified_body(_request(body, sig_header), SECRET))
+
+
+def test_known_vector(monkeypatch):
+    monkeypatch.setattr(time, "time", lambda: KNOWN_T + 10)
+    assert _verify(PAYLOAD, f"t={KNOWN_T},v1={KNOWN_V1}") == PAYLOAD
+
+
+def test_matches_stripe_sdk():
+    t = int(time.time())
+    header = f"t={t},v1={_sign(PAYLOAD, t)}"
+    assert _verify(PAYLOAD, header) == PAYLOAD
+    # The SDK accepts the same header, so both implement the same scheme.
+    stripe.Webhook.construct_event(PAYLOAD, header, SECRET)
+
+
+def test_tampered_body_rejected():
+    t = int(time.time())
+    header = f"t={t},v1={_sign(PAYLOAD, t)}"
+    with pytest.raises(ValueError, match="No signatures found"):
+        _verify(PAYLOAD.replace(b"completed", b"expired"), header)
+
+
+def test_wrong_secret_rejected():
+    t = int(time.time())
+    header = f"t={t},v1={_sign(PAYLOAD, t, secret='whsec_other')}"
+    with pytest.raises(ValueError, match="No signatures found"):
+        _verify(PAYLOAD, header)
+
+
+def test_stale_timestamp_rejected():
+    t = int(time.time()) - WEBHOOK_TOLERANCE - 1
+    header = f"t={t},v1={_sign(PAYLOAD, t)}"
+    with pytest.raises(ValueError, match="tolerance"):
+        _verify(PAYLOAD, header)
+
+
+def test_future_timestamp_rejected():
+    t = int(time.time()) + WEBHOOK_TOLERANCE + 1
+    header = f"t={t},v1={_sign(PAYLOAD, t)}"
+    with pytest.raises(ValueError, match="tolerance"):
+        _verify(PAYLOAD, header)
+
+
+def test_any_v1_matches_during_secret_roll():
+    t = int(time.time())
+    header = f"t={t},v1={_sign(PAYLOAD, t, secret='whsec_old')},v1={_sign(PAYLOAD, t)},v0=deadbeef"
+    assert _verify(PAYLOAD, header) == PAYLOAD
+
+
+def test_no_matching_v1_among_several_rejected():
+    t = int(time.time())
+    header = f"t={t},v1={_sign(PAYLOAD, t, secret='whsec_old')},v1={_sign(PAYLOAD, t, secret='whsec_other')}"
+    with pytest.raises(ValueError, match="No signatures found"):
+        _verify(PAYLOAD, header)
+
+
+def test_missing_header_rejected():
+    with pytest.raises(ValueError, match="Missing"):
+        _verify(PAYLOAD, None)
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        "",
+        "v1=abc",
+        "t=1700000000",
+        "t=abc,v1=abc",
+        "garbage",
+    ],
+)
+def test_malformed_header_rejected(header):
+    with pytest.raises(ValueError):
+        _parse_signature_header(header)